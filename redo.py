@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import argparse
-import doctest
-import fnmatch
+import contextvars
 import os
 import os.path
-import subprocess
 import sys
-import pickle
+
+# The other modules are imported only by the functions using them,
+# to keep the startup time low when the targets are up to date
 
 # Things to do
 # ============
@@ -28,6 +27,23 @@ class RedoException(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
 
+class TargetUpToDate(BaseException):
+    """
+    This exception stops the script of a target which has
+    been executed only to know the values it declares, when
+    they haven't changed. It isn't an Exception so the
+    scripts don't catch it by mistake.
+    """
+    pass
+
+class DependencyFailedException(RedoException):
+    """
+    This exception is raised when a target can't be
+    built because some of its dependencies failed
+    """
+    def __init__(self, msg):
+        RedoException.__init__(self, msg)
+
 class Graph(object):
     """
     This class reprents a DAG where nodes are target
@@ -36,20 +52,25 @@ class Graph(object):
     
     >>> g = Graph()
     >>> g.store_dependency("a", "b")
-    >>> for x in g.get_transitive_dependencies("a"): print x
+    >>> for x in g.get_transitive_dependencies("a"): print (x)
     a
     b
     >>> g.store_dependency("c", "d")
-    >>> for x in g.get_transitive_dependencies("c"): print x
+    >>> for x in g.get_transitive_dependencies("c"): print (x)
     c
     d
     >>> g.store_dependency("c", "d")
-    >>> for x in g.get_transitive_dependencies("c"): print x
+    >>> for x in g.get_transitive_dependencies("c"): print (x)
     c
     d
     >>> g.clear_dependency_info_for("c")
-    >>> for x in g.get_transitive_dependencies("c"): print x
+    >>> for x in g.get_transitive_dependencies("c"): print (x)
     c
+    >>> g.store_dependency("e", "a")
+    >>> for x in g.get_transitive_dependents(["b"]): print (x)
+    b
+    a
+    e
     """
     def __init__(self):
         self.store = {}
@@ -87,6 +108,14 @@ class Graph(object):
         if idx_t in self.store:
             self.store[idx_t]=[]
 
+    def get_dependencies(self, t):
+        """
+        This method will return the direct dependencies
+        of the passed target
+        """
+        t_idx = self.node_assoclist.get(t)
+        return [self.name_assoclist[x] for x in self.store.get(t_idx, [])]
+
     def get_transitive_dependencies(self, t):
         """
         This method will iterate into the graph and find
@@ -94,18 +123,46 @@ class Graph(object):
         """
         t_idx = self._ensure_node(t)
         to_check = [t_idx]
-        checked = []
-        while 1:
-            if len(to_check)==0: break
-            current = to_check[0]
-            to_check = to_check[1:]
+        checked = set(to_check)
+        position = 0
+        while position < len(to_check):
+            current = to_check[position]
+            position += 1
             
-            checked.append(to_check)
             yield self.name_assoclist[current]
             
             deplist = self.store.get(current)
-            if deplist!=None: to_check += deplist
+            if deplist!=None:
+                for dep in deplist:
+                    if dep not in checked:
+                        checked.add(dep)
+                        to_check.append(dep)
           
+    def get_transitive_dependents(self, targets):
+        """
+        This method will iterate into the graph and find
+        all the targets depending, directly or not, on
+        the passed ones
+        """
+        dependents = {}
+        for source in self.store.keys():
+            for dest in self.store[source]:
+                dependents.setdefault(dest, []).append(source)
+
+        to_check = [self.node_assoclist[t] for t in targets if t in self.node_assoclist]
+        checked = set(to_check)
+        position = 0
+        while position < len(to_check):
+            current = to_check[position]
+            position += 1
+
+            yield self.name_assoclist[current]
+
+            for dep in dependents.get(current, []):
+                if dep not in checked:
+                    checked.add(dep)
+                    to_check.append(dep)
+
     def to_tgf(self, file):
         """
         This method will iterate throught all the
@@ -121,20 +178,102 @@ class Graph(object):
             for dest in self.store[source]:
                 print (source,dest, file=file)
 
+def value_node_name(name):
+    """
+    Return the name of the virtual node which tracks
+    the value "name"
+
+    >>> print (value_node_name("cflags"))
+    value:cflags
+    """
+    return "value:" + name
+
+def env_node_name(name):
+    """
+    Return the name of the virtual node which tracks
+    the environment variable "name"
+
+    >>> print (env_node_name("CC"))
+    env:CC
+    """
+    return "env:" + name
+
+def canonical_value(value):
+    """
+    Return a canonical form of a value tracked by a virtual
+    node, which doesn't depend on the process computing it.
+    Only plain values are accepted: sets and dictionaries
+    are sorted.
+
+    >>> print (canonical_value({"-O2", "-g"}))
+    ('set', ("'-O2'", "'-g'"))
+    >>> print (canonical_value({"cc": "gcc", "flags": ["-g"]}))
+    ('dict', (("'cc'", 'gcc'), ("'flags'", ('-g',))))
+    >>> try: canonical_value(object())
+    ... except RedoException as e: print (e)
+    Cannot track a value of type object
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple([canonical_value(x) for x in value])
+    if isinstance(value, (set, frozenset)):
+        return ("set", tuple(sorted([repr(canonical_value(x)) for x in value])))
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted([(repr(canonical_value(k)), canonical_value(v)) for (k, v) in value.items()])))
+    raise RedoException("Cannot track a value of type " + type(value).__name__)
+
+def hash_value(value):
+    """
+    Return the hash of a value tracked by a virtual
+    node, computed on its canonical form
+    """
+    import hashlib
+    return hashlib.sha1(repr(canonical_value(value)).encode("utf-8")).hexdigest()
+
 class FileCache(object):
     """
     This class will contain the latest modification
-    time of files
+    time of files and the hash of the values tracked
+    by virtual nodes.
+
+    Virtual nodes have file type "v", for values declared
+    by the scripts, or "e", for environment variables.
+    Their hash is recorded for every target depending
+    on them, as every target was built with its own
+    value.
+
+    >>> fc = FileCache()
+    >>> fc.stamp_value("a", "env:CC", "clang", "e")
+    True
+    >>> fc.stamp_value("b", "env:CC", "clang", "e")
+    True
+    >>> fc.reset_changed_cache()
+    >>> fc.stamp_value("a", "env:CC", "gcc", "e")
+    True
+    >>> fc.is_value_changed("a", "env:CC")
+    False
+    >>> fc.is_value_changed("b", "env:CC")
+    True
+    >>> fc.stamp_value("a", "value:flags", ["-g"])
+    True
+    >>> fc.reset_changed_cache()
+    >>> print (fc.is_value_changed("a", "value:flags"))
+    None
+    >>> fc.stamp_value("a", "value:flags", ["-g"])
+    False
     """
     def __init__(self):
         self.store = {}
         self.changed_status = {}
+        self.current_values = {}
         
     def reset_changed_cache(self):
         """
         Reset the changed files cache
         """
         self.changed_status = {}
+        self.current_values = {}
         
     def stamp(self, fileName, fileType):
         """
@@ -142,6 +281,69 @@ class FileCache(object):
         """
         self.store[fileName] = {"timestamp":os.path.getmtime(fileName), "fileType":fileType}
 
+    def stamp_value(self, targetName, nodeName, value, fileType="v"):
+        """
+        Memorize the hash of the value of a virtual node for
+        the target "targetName". The value is also remembered
+        as the current value of this node for this build.
+        Return true if the value is different from the one
+        memorized for this target.
+        """
+        valueHash = hash_value(value)
+        self.current_values[self._value_key(targetName, nodeName, fileType)] = valueHash
+        entry = self.store.setdefault(nodeName, {"fileType":fileType, "hashes":{}})
+        changed = entry["hashes"].get(targetName)!=valueHash
+        entry["hashes"][targetName] = valueHash
+        return changed
+
+    def _value_key(self, targetName, nodeName, fileType):
+        """
+        Environment variables have the same value for every
+        target, the values declared by the scripts have the
+        value declared by the script of each target
+        """
+        if fileType=="e": return nodeName
+        return (targetName, nodeName)
+
+    def is_virtual(self, fileName):
+        """
+        Return true if the passed name is a known virtual node
+        """
+        return self.is_known(fileName) and self.get_type(fileName) in ("v", "e")
+
+    def get_current_value(self, targetName, nodeName):
+        """
+        Return the hash of the current value of a virtual node
+        for the target "targetName". Environment variables are
+        read from the environment, the values declared by the
+        scripts are known only after the script of the target
+        declared them in this build: if they aren't return None
+        """
+        fileType = self.get_type(nodeName)
+        key = self._value_key(targetName, nodeName, fileType)
+        if fileType=="e" and not (key in self.current_values):
+            varName = nodeName[len(env_node_name("")):]
+            self.current_values[key] = hash_value(os.environ.get(varName))
+        return self.current_values.get(key)
+
+    def is_value_changed(self, targetName, nodeName):
+        """
+        Check the current value of a virtual node against the
+        one memorized for the target "targetName". If the
+        current value isn't known return None
+        """
+        current = self.get_current_value(targetName, nodeName)
+        if current is None: return None
+        return current!=self.store[nodeName]["hashes"].get(targetName)
+
+    def get_current_stamp(self, fileName):
+        """
+        Return the current timestamp of a file. If the file
+        doesn't exist return None
+        """
+        if not os.path.exists(fileName): return None
+        return os.path.getmtime(fileName)
+
     def is_changed(self, fileName):
         """
         Check a file with the timestamp. If it
@@ -149,6 +351,11 @@ class FileCache(object):
         then return true. Else false.
         """
         if not self.is_known(fileName): raise RedoException("I don't know this target: " + fileName)
+
+        # The virtual nodes are checked for every target
+        # depending on them using "is_value_changed"
+        if self.is_virtual(fileName): return False
+
         if not os.path.exists(fileName): return True
         
         if fileName in self.changed_status:
@@ -211,7 +418,7 @@ def generate_script_for__basenames(baseName):
     This function will generate all the possible basenames
     for one target.
 
-    >>> for x in generate_script_for__basenames("testing.c.o"): print x
+    >>> for x in generate_script_for__basenames("testing.c.o"): print (x)
     testing.c.o.do
     default.c.o.do
     default.c.do
@@ -229,7 +436,7 @@ def generate_scripts_for(fileName):
     This function will generate all the possible script
     names for a target
     
-    >>> for x in generate_scripts_for("a/b/c/d/testing.c.o"): print x
+    >>> for x in generate_scripts_for("a/b/c/d/testing.c.o"): print (x)
     a/b/c/d/testing.c.o.do
     a/b/c/d/default.c.o.do
     a/b/c/d/default.c.do
@@ -351,44 +558,136 @@ def get_logging_subsystem():
 
 # }}}
 
+# {{{ Asynchronous scripts support
+# =================================
+
+# The context of the script being executed. It's a context variable
+# because asynchronous scripts are executed concurrently on the same
+# event loop
+_script_context = contextvars.ContextVar("script_context", default=None)
+
+def get_script_context():
+    "Return the context of the script being executed, or None"
+    return _script_context.get()
+
+def is_async_script(ctx):
+    """
+    Return true if the script executed in the context "ctx"
+    defines an "async def build(redo, target)" function
+    """
+    if not ("build" in ctx): return False
+    import inspect
+    return inspect.iscoroutinefunction(ctx["build"])
+# }}}
+
 # {{{ Utilities passed to scripts
 # ===============================
 
 class Utilities(object):
-    def __init__(self):
-        self.logging = get_logging_subsystem()
+    def __init__(self, logging=None):
+        if logging is None: logging = get_logging_subsystem()
+        self.logging = logging
+        self.jobs = 1
+        self._job_slots = None
+
+    def set_jobs(self, jobs):
+        """
+        Set how many commands can be run at the same time
+        """
+        if jobs<1: raise RedoException("The number of jobs must be at least 1")
+        self.jobs = jobs
+        self._job_slots = None
+
+    def _get_job_slots(self):
+        """
+        Return the semaphore limiting the commands run at the
+        same time. It's a thread semaphore, acquired by the
+        threads running the commands, because the event loops
+        of the nested asynchronous scripts run in other threads
+        and all of them share the same limit.
+        """
+        import threading
+        if self._job_slots is None:
+            self._job_slots = threading.BoundedSemaphore(self.jobs)
+        return self._job_slots
+
+    def _script_directory(self):
+        """
+        Return the directory of the script being executed. The
+        commands are run there, as the scripts are executed
+        without changing the current directory.
+        """
+        ctx = get_script_context()
+        if ctx is None: return None
+        return ctx["directory"]
+
+    def _script_path(self, fileName):
+        """
+        Return the name of a file relative to the directory of
+        the script being executed
+        """
+        directory = self._script_directory()
+        if directory is None: return fileName
+        return os.path.join(directory, fileName)
+
+    def _run_command(self, args, cwd, capture, slots):
+        """
+        Run a command waiting for a free slot in "slots". Return
+        the exit code and the captured output
+        """
+        import subprocess
+        with slots:
+            self.logging.command(args)
+            try:
+                process = subprocess.run(args, shell=type(args)!=type([]), cwd=cwd,
+                    stdout=subprocess.PIPE if capture else None)
+            except Exception as e:
+                raise RedoException(str(e))
+        return (process.returncode, process.stdout)
+
+    def _before_command(self, output=False):
+        """
+        Tell the script being executed that a command will
+        be run. "output" is true for the commands whose
+        output is captured.
+        """
+        ctx = get_script_context()
+        if ctx is not None:
+            ctx["redo"]._before_command(ctx, output)
         
     def parse_makefile_dependency(self, deps):    
         """
         Parse the passed string as a makefile 
         dependency. Useful for parsing the output
         of "gcc -M". This function will return a list
-        of every dependent file
+        of every dependent file. The relative names are
+        relative to the directory of the script.
         """
         # let's hope in the utf8 encoding
         if type(deps)==type(b""): deps = deps.decode("utf-8")
         deps = deps.split("\n")[1:]
         deps_collection = []
-        for dep in deps:
-            dep = dep.strip()
-            if len(dep)>0:
-                if dep[-1]=="\\": dep = dep[0:-1]
-                dep = dep.strip()
-                
-                if os.path.exists(dep):
+        for line in deps:
+            line = line.strip()
+            if len(line)>0 and line[-1]=="\\": line = line[0:-1]
+
+            # a line can list more than one file
+            for dep in line.split():
+                if os.path.exists(self._script_path(dep)):
                     deps_collection.append(dep)
-                
+
         return deps_collection
 
     def parse_dmd_dependency_file(self, depFile):
         """
         Read a depFile generated by dmd -deps=depFile
-        directive from the DMD2 compiler
+        directive from the DMD2 compiler. A relative depFile
+        is relative to the directory of the script.
         """
         
         dipendenze = []
 
-        f = open(depFile)
+        f = open(self._script_path(depFile))
         for linea in f:
           linea = linea.strip()
           inizio = linea.find("(")
@@ -418,13 +717,17 @@ class Utilities(object):
 
     def find_files(self, directory, pattern):
         """
-        Kinda-glob but recursive
+        Kinda-glob but recursive. A relative directory is
+        relative to the directory of the script, and so are
+        the file names found in it.
         """
-        for root, dirs, files in os.walk(directory):
+        import fnmatch
+        top = self._script_path(directory)
+        for root, dirs, files in os.walk(top):
             for basename in files:
                 if fnmatch.fnmatch(basename, pattern):
-                    filename = os.path.join(root, basename)
-                    yield filename    
+                    filename = os.path.join(directory, os.path.relpath(os.path.join(root, basename), top))
+                    yield filename
         
     def find_executable(self, executable, path=None):
         """
@@ -450,7 +753,7 @@ class Utilities(object):
                 extlist = pathext
         for ext in extlist:
             execname = executable + ext
-            if os.path.isfile(execname):
+            if os.path.isfile(self._script_path(execname)):
                 return execname
             else:
                 for p in paths:
@@ -465,47 +768,84 @@ class Utilities(object):
         Run a command. The command and the output will be
         shown only of the result of the command is wrong
         """
-        self.logging.command(args)
-        try:
-            if type(args)==type([]):
-                errorcode = subprocess.call(args)
-            else:
-                errorcode = subprocess.call(args, shell=True)
-        except Exception as e:
-            raise RedoException(str(e))
-            
-        if errorcode!=0:
-            self.logging.error(self.logging.format_command(args))
-            raise RedoException("compilation failed with exit code " + str(errorcode))
-                
+        self._before_command()
+        (errorcode, _) = self._run_command(args, self._script_directory(), False, self._get_job_slots())
+        self._check_exit_code(args, errorcode)
 
     def cmd_output(self, args):
         """
         Run a command and capture the stdout which will be
         returned as a string
         """
-        self.logging.command(args)
-        try:
-            if type(args)==type([]):
-                return subprocess.check_output(args)
-            else:
-                return subprocess.check_output(args, shell=True)
-        except Exception as e:
-            raise RedoException(str(e))
+        self._before_command(True)
+        (errorcode, output) = self._run_command(args, self._script_directory(), True, self._get_job_slots())
+        self._check_output_exit_code(args, errorcode)
+        return output
+
+    def _check_exit_code(self, args, errorcode):
+        if errorcode!=0:
+            self.logging.error(self.logging.format_command(args))
+            raise RedoException("compilation failed with exit code " + str(errorcode))
+
+    def _check_output_exit_code(self, args, errorcode):
+        if errorcode!=0:
+            raise RedoException("Command " + self.logging.format_command(args) +
+                " returned non-zero exit status " + str(errorcode))
+
+    async def _acall(self, args, cwd, capture):
+        """
+        Run a command in a thread of the event loop executor,
+        without blocking the event loop
+        """
+        import asyncio
+        self._before_command(capture)
+        if cwd is None: cwd = self._script_directory()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._run_command, args, cwd, capture, self._get_job_slots())
+
+    async def acmd(self, args, cwd=None):
+        """
+        Run a command as "cmd" does, without blocking the event
+        loop. At most "jobs" commands are run concurrently.
+        """
+        (errorcode, _) = await self._acall(args, cwd, False)
+        self._check_exit_code(args, errorcode)
+
+    async def acmd_output(self, args, cwd=None):
+        """
+        Run a command and capture the stdout as "cmd_output"
+        does, without blocking the event loop
+        """
+        (errorcode, output) = await self._acall(args, cwd, True)
+        self._check_output_exit_code(args, errorcode)
+        return output
 # }}}
         
 # {{{ Redo commands
 # =================
 
 class Redo(object):
-    def __init__(self):
+    def __init__(self, logging=None):
+        if logging is None: logging = get_logging_subsystem()
         self.graph = Graph()
         self.file_cache = FileCache()
-        self.contexts = []
-        self.logging = get_logging_subsystem()
-        self.utils = Utilities()
+        self.logging = logging
+        self.utils = Utilities(logging)
+        self.keep_going = False
+        self.retry_failed = False
+        self.failures = {}
+        self._current_db_version = 4
+        self._reset_build_status()
+
+    def _reset_build_status(self):
+        """
+        Forget the targets built, and failed, by the
+        current build
+        """
         self.built_targets = []
-        self._current_db_version = 1
+        self.failed_targets = []
+        self._build_failures = {}
+        self._pending_builds = {}
 
     # Read and write graph to file
     # ----------------------------
@@ -514,77 +854,397 @@ class Redo(object):
         """
         Write the current build status to a file
         """
+        import pickle
         self.file_cache.reset_changed_cache()
-        self.built_targets = []
+        self._reset_build_status()
         
         f = open(fileName, "wb")
         pickle.dump(self._current_db_version, f)
         pickle.dump(self.graph, f)
         pickle.dump(self.file_cache, f)
+        pickle.dump(self.failures, f)
         f.close()
         
     def read_status_from_file(self, fileName):
         """
         Read the current build status to a file
         """
+        import pickle
+
+        class Unpickler(pickle.Unpickler):
+            # The classes are pickled with the name of the module which
+            # wrote them: "__main__" when redo.py is run as a script and
+            # "redo" when it's imported
+            def find_class(self, module, name):
+                if module in ("__main__", "redo", __name__) and name in ("Graph", "FileCache"):
+                    return globals()[name]
+                return pickle.Unpickler.find_class(self, module, name)
+
         f = open(fileName, "rb")
-        dbver = pickle.load(f)
+        dbver = Unpickler(f).load()
         
         if dbver!=self._current_db_version:
             raise RedoException("Wrong _redo.db version. Please regenerate it from scratch")
             
-        self.graph = pickle.load(f)
-        self.file_cache = pickle.load(f)
+        self.graph = Unpickler(f).load()
+        self.file_cache = Unpickler(f).load()
+        self.failures = Unpickler(f).load()
         f.close()
         self.rootdir = os.path.dirname(fileName)
 
     # Script execution and contexts
     # -----------------------------
 
-    def _create_context(self, scriptName, targetName):
+    def _create_context(self, scriptName, targetName, probe=False):
+        parent = get_script_context()
         context = {"target":targetName, 
             "basename":os.path.splitext(targetName)[0], 
             "redo":self,
-            "scriptname":scriptName
+            "scriptname":scriptName,
+            "directory":os.path.dirname(os.path.abspath(scriptName)),
+            "depth":1 if parent is None else parent["depth"]+1,
+            "dependencies_cleared":False,
+            "previous_dependencies":set(self.graph.get_dependencies(targetName)),
+            "probe":probe,
+            "outdated":False,
+            "declared_values":set(),
+            "failed_dependencies":[]
         }
         return context
         
-    def _exec_script(self, scriptName, targetName):
-        (scriptPath, scriptBasename) = os.path.split(scriptName)
-        
-        cwd = os.getcwd()
-        if scriptPath != "": os.chdir(scriptPath)
-        ctx = self._create_context(scriptName, targetName)
-        self.contexts.append(ctx)
-        self.logging.target(len(self.contexts), targetName)
+    def _load_script(self, scriptName, targetName, probe=False):
+        """
+        Execute the body of a script and return its
+        context. The current directory isn't changed: the
+        directory of the script is in the context, and the
+        commands and the file names are relative to it.
+        """
+        ctx = self._create_context(scriptName, targetName, probe)
+        token = _script_context.set(ctx)
+        self.logging.target(ctx["depth"], targetName)
+        try:
+            exec(compile(open(scriptName).read(), scriptName, 'exec'), ctx)
+        finally:
+            _script_context.reset(token)
+        return ctx
+
+    def _exec_script(self, scriptName, targetName, probe=False):
+        ctx = self._load_script(scriptName, targetName, probe)
+        if is_async_script(ctx):
+            self._run_coroutine(self._call_build(ctx))
+        self._check_failed_dependencies(ctx)
+
+    async def _call_build(self, ctx):
+        """
+        Run the "build" coroutine of an asynchronous script
+        """
+        token = _script_context.set(ctx)
         try:
-            exec(compile(open(scriptBasename).read(), scriptBasename, 'exec'), ctx)
+            await ctx["build"](self, ctx["target"])
         finally:
-            self.contexts.pop()
-            os.chdir(cwd)
+            _script_context.reset(token)
+
+    async def _with_executor(self, coro):
+        """
+        Run "coro" with an executor having a thread for
+        every command which can be run at the same time
+        """
+        import asyncio
+        import concurrent.futures
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(self.utils.jobs))
+        return await coro
+
+    def _run_coroutine(self, coro):
+        """
+        Run a coroutine in a new event loop. If an event loop
+        is already running in this thread, i.e. a synchronous
+        script has been called by an asynchronous one, the
+        new event loop is run in another thread.
+        """
+        import asyncio
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._with_executor(coro))
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, self._with_executor(coro)).result()
             
     def _current_context(self):
-        return self.contexts[-1]
+        return get_script_context()
+
+    def _before_command(self, ctx, output=False):
+        """
+        Called before a script runs a command. The script is
+        stopped here if some of its dependencies failed or if
+        it has been executed only to know its values, and
+        nothing changed. The commands whose output is captured
+        are run, as they usually compute the values.
+        """
+        self._check_failed_dependencies(ctx)
+        if not ctx["probe"] or output: return
+        if not ctx["outdated"] and self._values_declared_again(ctx): raise TargetUpToDate()
+        ctx["probe"] = False
+
+    def _values_declared_again(self, ctx):
+        """
+        Return true if the script has already declared all the
+        values it declared in the previous build. If it hasn't
+        they can't be checked, and the target is rebuilt.
+        """
+        for dep in ctx["previous_dependencies"]:
+            if self.file_cache.is_known(dep) and self.file_cache.get_type(dep)=="v":
+                if not (dep in ctx["declared_values"]): return False
+        return True
+
+    def _target_up_to_date(self, targetName, previousDependencies):
+        """
+        The script of a target has been stopped because the
+        target is up to date: the dependencies it didn't
+        declare are restored
+        """
+        self.logging.debug("target " + targetName + " is up to date")
+        for dep in previousDependencies:
+            self.graph.store_dependency(targetName, dep)
+        self.built_targets.append(targetName)
+
+    def _resolve(self, fileName):
+        """
+        Return the absolute name of a file, relative to the
+        directory of the current script
+        """
+        ctx = self._current_context()
+        if ctx is not None:
+            fileName = os.path.join(ctx["directory"], fileName)
+        return os.path.abspath(fileName)
         
     # Redo commands
     # -------------
+
+    def build(self, targetNames):
+        """
+        This function will rebuild the targets in "targetNames"
+        which aren't up to date. If some targets failed their
+        errors are logged and a RedoException is raised.
+        """
+        self.file_cache.reset_changed_cache()
+        self._reset_build_status()
+
+        for targetName in targetNames:
+            status = self._check_target(targetName)
+            if status:
+                self.logging.debug("target " + targetName + " is up to date")
+                continue
+            try:
+                self._redo(targetName, status is None)
+            except RedoException:
+                if len(self.failed_targets)==0: raise
+                if not self.keep_going: break
+
+        if len(self.failed_targets)>0:
+            for (target, error) in self.failed_targets:
+                self.logging.error(target + ": " + error)
+            raise RedoException(str(len(self.failed_targets)) + " target(s) failed")
             
     def redo(self, targetName):
         """
         This function will always rebuild the target
         "targetName"
         """
-        targetName = os.path.abspath(targetName)
-        
-        if targetName not in self.built_targets:
-            scriptName = find_script_for(targetName)
-            self.file_cache.stamp(scriptName, "s")
-            self.graph.store_dependency(targetName, scriptName)
-            self._exec_script(scriptName, targetName)
-            self.built_targets.append(targetName)
-            
-            if os.path.exists(targetName):
-                self.file_cache.stamp(targetName, "d")
+        self._redo(targetName, False)
+
+    def _redo(self, targetName, probe):
+        """
+        Rebuild the target "targetName". If "probe" is true
+        the target script is executed only to know the values
+        it declares, and it's stopped before running any command
+        if nothing changed. Return true if the target has been
+        rebuilt.
+        """
+        targetName = self._resolve(targetName)
+
+        if targetName in self.built_targets: return False
+        self._check_pending_build(targetName, None)
+        self._check_failure(targetName)
+        previousDependencies = self.graph.get_dependencies(targetName)
+        try:
+            scriptName = self._prepare_target(targetName)
+            self._exec_script(scriptName, targetName, probe)
+        except TargetUpToDate:
+            self._target_up_to_date(targetName, previousDependencies)
+            return False
+        except RedoException as e:
+            self._target_failed(targetName, e, previousDependencies)
+            raise
+        self._target_built(targetName)
+        return True
+
+    async def aredo(self, targetName):
+        """
+        As redo but for asynchronous scripts: the
+        "build" coroutine of the target script is
+        awaited in the current event loop. Concurrent
+        requests for the same target will share the
+        same build.
+        """
+        await self._aredo(targetName, False)
+
+    async def _aredo(self, targetName, probe):
+        """
+        As _redo but for asynchronous scripts
+        """
+        import asyncio
+        targetName = self._resolve(targetName)
+
+        if targetName in self.built_targets: return False
+        loop = asyncio.get_running_loop()
+        task = self._check_pending_build(targetName, loop)
+        if task is None:
+            task = asyncio.ensure_future(self._aredo_target(targetName, probe))
+            self._pending_builds[targetName] = (loop, task)
+        return await task
+
+    def _check_pending_build(self, targetName, loop):
+        """
+        Return the task building the target in the event loop
+        "loop", or None if it isn't being built. The synchronous
+        scripts, and the event loops they run, block the event
+        loop which called them: a target being built by another
+        event loop can't be waited for, so an exception is raised
+        instead of building it twice at the same time.
+        """
+        pending = self._pending_builds.get(targetName)
+        if pending is None: return None
+        (pendingLoop, task) = pending
+        if pendingLoop is loop: return task
+        raise RedoException("Cannot build " + targetName + " while an asynchronous script " +
+            "waiting for this one is building it: the scripts between them must be asynchronous")
+
+    async def _aredo_target(self, targetName, probe):
+        try:
+            self._check_failure(targetName)
+            previousDependencies = self.graph.get_dependencies(targetName)
+            try:
+                scriptName = self._prepare_target(targetName)
+                ctx = self._load_script(scriptName, targetName, probe)
+                if is_async_script(ctx):
+                    await self._call_build(ctx)
+                self._check_failed_dependencies(ctx)
+            except TargetUpToDate:
+                self._target_up_to_date(targetName, previousDependencies)
+                return False
+            except RedoException as e:
+                self._target_failed(targetName, e, previousDependencies)
+                raise
+            self._target_built(targetName)
+            return True
+        finally:
+            del self._pending_builds[targetName]
+
+    def _prepare_target(self, targetName):
+        """
+        Find the script for a target, memorizing it
+        as a dependency
+        """
+        scriptName = find_script_for(targetName)
+        self.file_cache.stamp(scriptName, "s")
+        self.graph.store_dependency(targetName, scriptName)
+        return scriptName
+
+    def _target_built(self, targetName):
+        self.built_targets.append(targetName)
+        if targetName in self.failures:
+            del self.failures[targetName]
+        if os.path.exists(targetName):
+            self.file_cache.stamp(targetName, "d")
+
+    # Failed targets
+    # --------------
+
+    def _target_failed(self, targetName, exc, previousDependencies):
+        """
+        Memorize the failure of a target. Only the targets
+        whose script failed are reported, the ones failed
+        because of their dependencies aren't.
+
+        The script may have failed before declaring all its
+        dependencies, so the ones of the previous build are
+        kept too. The failure is cached with the stamps of
+        these inputs only if the target has been built
+        before, as otherwise they may be incomplete.
+        """
+        for dep in previousDependencies:
+            self.graph.store_dependency(targetName, dep)
+
+        self._build_failures[targetName] = str(exc)
+        if isinstance(exc, DependencyFailedException): return
+        if getattr(exc, "failed_target", None) is not None: return
+
+        exc.failed_target = targetName
+        self.failed_targets.append((targetName, str(exc)))
+        if self.file_cache.is_known(targetName) and self.file_cache.get_type(targetName)=="d":
+            self.failures[targetName] = {"error":str(exc), "stamps":self._input_stamps(targetName)}
+
+    def _check_failure(self, targetName):
+        """
+        Raise again the error of a target which already failed
+        in this build, or in a previous one if its inputs
+        haven't changed since then. The failures of the previous
+        builds are ignored if "retry_failed" is true.
+        """
+        if targetName in self._build_failures:
+            exc = RedoException(self._build_failures[targetName])
+            exc.failed_target = targetName
+            raise exc
+
+        failure = self.failures.get(targetName)
+        if failure is None or self.retry_failed: return
+        stamps = self._input_stamps(targetName)
+        if stamps is None or failure["stamps"]!=stamps: return
+
+        exc = RedoException(failure["error"])
+        exc.failed_target = targetName
+        self._build_failures[targetName] = failure["error"]
+        self.failed_targets.append((targetName, failure["error"] + " (cached)"))
+        raise exc
+
+    def _input_stamps(self, targetName):
+        """
+        Return the current stamps of the transitive dependencies
+        of a target, and the current values of the virtual nodes
+        they depend on. If some values aren't known yet return
+        None
+        """
+        stamps = {}
+        for dep in self.graph.get_transitive_dependencies(targetName):
+            if self.file_cache.is_virtual(dep): continue
+            if dep!=targetName:
+                stamps[dep] = self.file_cache.get_current_stamp(dep)
+            for node in self._virtual_dependencies(dep):
+                stamps[(dep, node)] = self.file_cache.get_current_value(dep, node)
+                if stamps[(dep, node)] is None: return None
+        return stamps
+
+    def _virtual_dependencies(self, targetName):
+        """
+        Return the virtual nodes the target directly depends on
+        """
+        return [x for x in self.graph.get_dependencies(targetName) if self.file_cache.is_virtual(x)]
+
+    def _check_failed_dependencies(self, ctx):
+        """
+        Raise the exception telling that the target of the
+        context "ctx" can't be built because of the failed
+        dependencies. With "keep_going" the dependencies are
+        collected while the script declares them, and this
+        is checked before running a command and when the
+        script ends.
+        """
+        if len(ctx["failed_dependencies"])==0: return
+        raise DependencyFailedException("Cannot build " + ctx["target"] +
+            " because of the failed dependencies: " + ", ".join(ctx["failed_dependencies"]))
 
     def if_changed(self, *targetNames):
         """
@@ -592,16 +1252,107 @@ class Redo(object):
         a dependency versus name choosen in "targetNames" and
         will rebuild it if the dependencies are outdate.
         """
-        self.graph.clear_dependency_info_for(self._current_context()["target"])
-        self.graph.store_dependency(self._current_context()["target"], self._current_context()["scriptname"])
+        self._clear_dependencies()
         for argument in targetNames:
-            self._if_changed_file(argument)
+            try:
+                self._if_changed_file(argument)
+            except RedoException as e:
+                if not (self.keep_going and self._is_dependency_failure(e)): raise
+                self._current_context()["failed_dependencies"].append(argument)
+
+    async def aif_changed(self, *targetNames):
+        """
+        As if_changed but for asynchronous scripts: the
+        outdated targets are rebuilt concurrently
+        """
+        import asyncio
+        self._clear_dependencies()
+        results = await asyncio.gather(*[self._aif_changed_file(x) for x in targetNames],
+            return_exceptions=self.keep_going)
+        for (argument, result) in zip(targetNames, results):
+            if isinstance(result, BaseException):
+                if not self._is_dependency_failure(result): raise result
+                self._current_context()["failed_dependencies"].append(argument)
+
+    def _is_dependency_failure(self, exc):
+        """
+        Return true if the exception raised while checking a
+        dependency tells that the dependency failed, and it has
+        already been reported. The other errors are errors of the
+        script declaring the dependency.
+        """
+        if isinstance(exc, DependencyFailedException): return True
+        return isinstance(exc, RedoException) and getattr(exc, "failed_target", None) is not None
+
+    def if_value_changed(self, name, value):
+        """
+        This function will append to the current target
+        a dependency versus the value "value" named "name".
+        The target will be rebuilt when the value changes.
+        To know the value the script is executed in every
+        build, and it's stopped before running its first
+        command if nothing changed. The commands run by
+        cmd_output don't stop it. If a value is declared
+        after a command the target is rebuilt in every build.
+        """
+        self._clear_dependencies()
+        self._if_changed_value(value_node_name(name), value, "v")
+
+    def if_env_changed(self, *varNames):
+        """
+        This function will append to the current target
+        a dependency versus the environment variables
+        listed in "varNames"
+        """
+        self._clear_dependencies()
+        for varName in varNames:
+            self._if_changed_value(env_node_name(varName), os.environ.get(varName), "e")
+
+    def _clear_dependencies(self):
+        """
+        Remove the dependency info of the current target, only
+        the first time it's called by the script
+        """
+        ctx = self._current_context()
+        if ctx["dependencies_cleared"]: return
+        ctx["dependencies_cleared"] = True
+        self.graph.clear_dependency_info_for(ctx["target"])
+        self.graph.store_dependency(ctx["target"], ctx["scriptname"])
+
+    def _if_changed_value(self, nodeName, value, nodeType):
+        """
+        As if_changed but for only one virtual node
+        """
+        ctx = self._current_context()
+        self.graph.store_dependency(ctx["target"], nodeName)
+        if nodeType=="v": ctx["declared_values"].add(nodeName)
+        if self.file_cache.stamp_value(ctx["target"], nodeName, value, nodeType):
+            ctx["outdated"] = True
         
     def _if_changed_file(self, argument):
         """
         As if_changed but for only one file
         """
-        argument = os.path.abspath(argument)
+        argument = self._resolve(argument)
+        status = self._check_dependency(argument)
+        if not status and self._redo(argument, status is None):
+            self._current_context()["outdated"] = True
+
+    async def _aif_changed_file(self, argument):
+        """
+        As aif_changed but for only one file
+        """
+        argument = self._resolve(argument)
+        status = self._check_dependency(argument)
+        if not status and await self._aredo(argument, status is None):
+            self._current_context()["outdated"] = True
+
+    def _check_dependency(self, argument):
+        """
+        Append to the current target a dependency versus
+        the file "argument" and check it as _check_target
+        does
+        """
         if not self.file_cache.is_known(argument):
             if os.path.exists(argument):
                 currentType = "s"
@@ -610,28 +1361,70 @@ class Redo(object):
         else:
             currentType = self.file_cache.get_type(argument)
 
-        current = self._current_context()["target"]
-        if argument != current: 
-            self.graph.store_dependency(current, argument)
+        ctx = self._current_context()
+        if argument != ctx["target"]: 
+            self.graph.store_dependency(ctx["target"], argument)
+            if not (argument in ctx["previous_dependencies"]):
+                ctx["outdated"] = True
 
         if currentType=="s":
+            if self.file_cache.is_known(argument) and self.file_cache.is_changed(argument):
+                ctx["outdated"] = True
             self.file_cache.stamp(argument, currentType)
-        elif currentType=="d" and (not self.file_cache.is_known(argument)):
-            self.redo(argument)
-        elif currentType=="d" and self.file_cache.is_known(argument):
-            to_rebuild = False
-            to_rebuild_cause = ""
-            for dep in self.graph.get_transitive_dependencies(argument):
-                if self.file_cache.is_changed(dep):
-                    to_rebuild = True
-                    to_rebuild_cause = dep
-                    break
-                    
-            if to_rebuild:
-                # print "target",argument,"must be rebuild because",to_rebuild_cause,"changed"
-                self.redo(argument)
+        elif currentType=="d":
+            return self._check_target(argument)
+        return True
+
+    def is_up_to_date(self, targetName):
+        """
+        Return true if the target "targetName" has already
+        been built and none of its dependencies has changed,
+        false if it must be rebuilt. If it depends on values
+        declared by the scripts, which are known only by
+        running them, and nothing else changed return None.
+        """
+        return self._check_target(targetName)
+
+    def _check_target(self, targetName):
+        """
+        Return true if the target "targetName" is up to date
+        and false if it must be rebuilt. If it depends on
+        values which haven't been declared yet in this build
+        return None: the scripts must be executed to know
+        them.
+        """
+        targetName = self._resolve(targetName)
+        if not self.file_cache.is_known(targetName): return False
+        if self.file_cache.get_type(targetName)!="d": return True
+
+        result = True
+        for dep in self.graph.get_transitive_dependencies(targetName):
+            if dep in self.failures:
+                self.logging.debug("target " + targetName + " must be rebuild because " + dep + " failed")
+                return False
+            if self.file_cache.is_changed(dep):
+                self.logging.debug("target " + targetName + " must be rebuild because " + dep + " changed")
+                return False
+            for node in self._virtual_dependencies(dep):
+                changed = self.file_cache.is_value_changed(dep, node)
+                if changed:
+                    self.logging.debug("target " + targetName + " must be rebuild because " + node + " changed for " + dep)
+                    return False
+                if changed is None:
+                    result = None
+        return result
+
+    def affected(self, fileNames):
+        """
+        This function will return the targets depending,
+        directly or not, on the files in "fileNames"
+        """
+        fileNames = [self._resolve(x) for x in fileNames]
+        return [x for x in self.graph.get_transitive_dependents(fileNames)
+            if self.file_cache.is_known(x) and self.file_cache.get_type(x)=="d"]
 
     def clean(self):
+        self.failures = {}
         for target in self.file_cache.get_destinations():
             if os.path.exists(target):
                 self.logging.clean(target)
@@ -645,6 +1438,79 @@ class Redo(object):
         self.graph.to_tgf(sys.stdout)
 # }}}        
             
+# {{{ Embedding API
+# =================
+
+class RedoSession(object):
+    """
+    This class lets Python programs drive the builds. The
+    database is read when the session is created and kept
+    in memory between the builds: call "flush" to write
+    it back.
+
+        session = RedoSession("project/_redo.db")
+        session.build(["hello"], jobs=4)
+        if not session.is_up_to_date("hello"): ...
+        session.flush()
+
+    The targets are relative to the database directory and
+    the session has its own logging subsystem. The scripts
+    don't change the current directory and the script being
+    executed is kept in a context variable, so different
+    threads can use different sessions at the same time. A
+    session runs one build at a time.
+    """
+    def __init__(self, dbname=None, logging=None):
+        if dbname is None: dbname = find_redo_database()
+        if logging is None: logging = Logging()
+        self.dbname = os.path.abspath(dbname)
+        self.rootdir = os.path.dirname(self.dbname)
+        self.logging = logging
+        self.redo = Redo(logging)
+        self.redo.read_status_from_file(self.dbname)
+        self._changed = False
+
+    def _resolve(self, fileName):
+        return os.path.normpath(os.path.join(self.rootdir, fileName))
+
+    def build(self, targets, jobs=1, keep_going=False, retry_failed=False):
+        """
+        Build the targets which aren't up to date. A
+        RedoException is raised if some of them failed
+        """
+        self.redo.utils.set_jobs(jobs)
+        self.redo.keep_going = keep_going
+        self.redo.retry_failed = retry_failed
+        self._changed = True
+        self.redo.build([self._resolve(x) for x in targets])
+
+    def is_up_to_date(self, target):
+        """
+        Return true if the target has already been built and
+        none of its dependencies has changed, false if it must
+        be rebuilt and None if this depends on the values
+        declared by the scripts: they are known only while
+        the scripts are executed by "build".
+        """
+        self.redo.file_cache.reset_changed_cache()
+        return self.redo.is_up_to_date(self._resolve(target))
+
+    def affected(self, paths):
+        """
+        Return the targets which depends, directly or not,
+        on the passed files
+        """
+        return self.redo.affected([self._resolve(x) for x in paths])
+
+    def flush(self):
+        """
+        Write the database, if something has been built
+        """
+        if not self._changed: return
+        self.redo.write_status_to_file(self.dbname)
+        self._changed = False
+# }}}
+
 # {{{ Redo database management
 # ============================
 
@@ -655,8 +1521,13 @@ def redo_database_default_name():
 def find_redo_database():
     """
     This function will search for a redo database in the current
-    directory and in all the parent directories
+    directory and in all the parent directories. If the
+    REDO_DATABASE environment variable is set it will be used
+    instead.
     """
+    if os.environ.get("REDO_DATABASE"):
+        return os.path.abspath(os.environ["REDO_DATABASE"])
+
     thisDirectory = os.path.abspath(os.getcwd())
     db_name = redo_database_default_name()
     tests = []
@@ -681,8 +1552,20 @@ def find_redo_database():
 # =================
 
 def main_test():
+    import doctest
     print ("testing...")
-    doctest.testmod()
+    failed = doctest.testmod().failed
+
+    # The doctest files in the "t" directory build small
+    # projects using this module and the "fixture" helpers
+    testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "t")
+    sys.path.insert(0, testdir)
+    for name in sorted(os.listdir(testdir)):
+        if name.endswith(".txt"):
+            failed += doctest.testfile(os.path.join(testdir, name), module_relative=False,
+                globs={"redo":sys.modules[__name__]}).failed
+
+    if failed>0: sys.exit(1)
     
 def main_clean():
     redo = Redo()
@@ -705,16 +1588,40 @@ def main_init():
     else:
         get_logging_subsystem().error("Database file (" + default_db + ") already exists")
         
-def main_redo(targetName):
+def main_redo(targetName, jobs=1, keep_going=False, retry_failed=False):
     redo = Redo()
+    redo.utils.set_jobs(jobs)
+    redo.keep_going = keep_going
+    redo.retry_failed = retry_failed
     dbname = find_redo_database()
     redo.read_status_from_file(dbname)
+    if redo.is_up_to_date(targetName):
+        redo.logging.debug("target " + targetName + " is up to date")
+        return
     try:
-        redo.redo(targetName)
+        redo.build([targetName])
     finally:
         redo.write_status_to_file(dbname)
 
+def jobs_number(value):
+    """
+    Parse the number of jobs from the command line
+    """
+    import argparse
+    jobs = int(value)
+    if jobs<1: raise argparse.ArgumentTypeError("the number of jobs must be at least 1")
+    return jobs
+
 def main_argparse():
+    # Fast path for the plain "build <target>" command, which is used
+    # by the editors on every save: argparse is slow to import and the
+    # default options are already in place
+    if len(sys.argv)==3 and sys.argv[1]=="build" and not sys.argv[2].startswith("-"):
+        main_redo(sys.argv[2])
+        return
+
+    import argparse
+
     # Main command parser
     parser = argparse.ArgumentParser(prog=sys.argv[0])
     parser.add_argument("--logging-level", dest="logging_level", type=int, 
@@ -731,9 +1638,18 @@ def main_argparse():
     # Parser for the "tgf" command
     parser_tgf = subparsers.add_parser("tgf", help="generate a tgf file from the build system graph")
     
+    # Parser for the "test" command
+    parser_test = subparsers.add_parser("test", help="run the P-Redo tests")
+    
     # Parser for the "build" command
     parser_build = subparsers.add_parser("build", help="build a target")
     parser_build.add_argument("target", help="target to build")
+    parser_build.add_argument("-j", "--jobs", dest="jobs", type=jobs_number, default=1,
+        help="number of commands run concurrently by the asynchronous scripts. The default is 1")
+    parser_build.add_argument("-k", "--keep-going", dest="keep_going", action="store_true",
+        help="build all the targets not depending on a failed one and report all the failures")
+    parser_build.add_argument("--retry-failed", dest="retry_failed", action="store_true",
+        help="run again the targets which failed in the previous builds even if their inputs haven't changed")
     
     # Parse the command line arguments
     parameters = parser.parse_args(sys.argv[1:])
@@ -753,20 +1669,23 @@ def main_argparse():
         main_clean()
     elif parameters.command_name == "tgf":
         main_tgf()
+    elif parameters.command_name == "test":
+        main_test()
     elif parameters.command_name == "build":
-        main_redo(parameters.target)
+        main_redo(parameters.target, parameters.jobs, parameters.keep_going, parameters.retry_failed)
     
 
 if __name__=="__main__": 
     # Check the current python version.
-    # It must be at least 2.7 because we use "argparse"
-    # to parse the command line arguments
-    if sys.version_info.major<2 or (sys.version_info.major==2 and sys.version_info.minor<7):
-        print ("This software requires Python 2.7 or better! Please update your Python interpreter", file=stderr)
+    # It must be at least 3.7 because we use "contextvars"
+    # and "asyncio" for the asynchronous scripts
+    if sys.version_info.major<3 or (sys.version_info.major==3 and sys.version_info.minor<7):
+        print ("This software requires Python 3.7 or better! Please update your Python interpreter", file=sys.stderr)
     else:
         try:
             main_argparse()
         except RedoException as e:
             print (e, file=sys.stderr)
+            sys.exit(1)
 
 # }}}
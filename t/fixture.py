@@ -0,0 +1,110 @@
+"""
+Helpers for the doctest files in this directory, which build small
+projects in temporary directories. The commands of the projects are
+run by "produce.py", which writes its arguments to the target and
+logs in "runs.txt" when it starts and when it ends. It fails if an
+argument is "broken" and, when called with "--overlap N", it waits
+for N commands to be started before ending.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+PRODUCE = """import os, sys, time
+log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runs.txt")
+name = os.path.basename(sys.argv[1])
+args = sys.argv[2:]
+overlap = 0
+if args[:1]==["--overlap"]:
+    overlap = int(args[1])
+    args = args[2:]
+
+def started():
+    if not os.path.exists(log): return 0
+    return len([x for x in open(log).read().split("\\n") if x.startswith("start ")])
+
+open(log, "a").write("start " + name + "\\n")
+for i in range(1000):
+    if started()>=overlap: break
+    time.sleep(0.01)
+else:
+    sys.exit("timeout waiting for " + str(overlap) + " commands")
+if "broken" in args: sys.exit(1)
+open(sys.argv[1], "w").write(" ".join(args))
+open(log, "a").write("end " + name + "\\n")
+"""
+
+class Project(object):
+    """
+    A project in a temporary directory, with an empty redo
+    database. "redo" is the module under test.
+    """
+    def __init__(self, redo):
+        self.redo = redo
+        self.directory = tempfile.mkdtemp()
+        self.dbname = self.path("_redo.db")
+        self.errors = []
+        self.write("produce.py", PRODUCE)
+        redo.Redo().write_status_to_file(self.dbname)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        if not os.path.isdir(os.path.dirname(self.path(name))):
+            os.makedirs(os.path.dirname(self.path(name)))
+        f = open(self.path(name), "w")
+        f.write(text)
+        f.close()
+
+    def read(self, name):
+        f = open(self.path(name))
+        result = f.read()
+        f.close()
+        return result
+
+    def _log(self):
+        "Return the lines logged by produce.py, and forget them"
+        if not os.path.exists(self.path("runs.txt")): return []
+        result = self.read("runs.txt").split("\n")[:-1]
+        os.unlink(self.path("runs.txt"))
+        return result
+
+    def runs(self):
+        "Return the targets produce.py has been started for"
+        return [x.split(" ")[1] for x in self._log() if x.startswith("start ")]
+
+    def running(self):
+        "Return the largest number of commands which were running together"
+        result, running = 0, 0
+        for line in self._log():
+            running += 1 if line.startswith("start ") else -1
+            result = max(result, running)
+        return result
+
+    def logging(self):
+        """
+        Return a logging subsystem showing nothing, which
+        remembers the errors in "errors"
+        """
+        project = self
+        class QuietLogging(self.redo.Logging):
+            def __init__(self):
+                project.redo.Logging.__init__(self)
+                self.configure_from_logging_level(0)
+            def error(self, exc):
+                project.errors.append(str(exc))
+        return QuietLogging()
+
+    def session(self):
+        return self.redo.RedoSession(self.dbname, self.logging())
+
+    def command(self, *args):
+        "Run redo.py in the project directory and return its exit code"
+        return subprocess.run([sys.executable, os.path.abspath(self.redo.__file__)] + list(args),
+            cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+    def remove(self):
+        shutil.rmtree(self.directory)
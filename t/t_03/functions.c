@@ -0,0 +1,5 @@
+#include "functions.h"
+
+int sum(int a, int b) {
+  return a+b;
+}
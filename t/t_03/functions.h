@@ -0,0 +1,9 @@
+#ifndef __FUNCTIONS_H
+#define __FUNCTIONS_H
+
+/**
+ * This function will sum two numbers
+ */
+int sum(int a, int b);
+
+#endif